@@ -9,32 +9,47 @@ import os
 import re
 import shutil
 import stat
+import sys
 import tempfile
 
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from datetime import timezone
 from functools import cached_property
+from functools import lru_cache
+from operator import attrgetter
 from pathlib import Path
 from subprocess import PIPE
 from subprocess import check_call
 from typing import TYPE_CHECKING
+from typing import cast
 from zipfile import ZIP_DEFLATED
+from zipfile import ZIP_STORED
 from zipfile import ZipFile
 from zipfile import ZipInfo
 
-import tomlkit
-
+from cleo.io.null_io import NullIO
 from poetry.core.masonry.builders.builder import Builder
 from poetry.core.masonry.builders.builder import BuildIncludeFile
 from poetry.core.masonry.utils.helpers import distribution_name
 from poetry.core.masonry.utils.helpers import normalize_file_permissions
 from poetry.core.utils.helpers import temporary_directory
+from poetry_plugin_export.exporter import Exporter
+
+
+if sys.version_info >= (3, 11):
+    import tomllib
+else:
+    import tomli as tomllib
 
 
 if TYPE_CHECKING:
     from collections.abc import Iterable
+    from collections.abc import Iterator
+    from typing import Any
 
     from poetry.core.masonry.utils.module import Module
+    from poetry.poetry import Poetry
 
 # as builders have their own logging format, and can't be extended
 # as of now, we set the logger for NarBuilder to the same as Builder
@@ -51,6 +66,154 @@ Nar-Group: {name}
 Nar-Version: {version}
 """
 
+# size of the chunks used to stream file contents into the nar
+COPY_BUFFER_SIZE = 1 << 20
+
+# placeholders filled in with the dynamic metadata from pyproject.toml
+VERSION_RE = re.compile(r"""version\s*=\s*["']__version__["']""")
+DESCRIPTION_RE = re.compile(r"""description\s*=\s*["']__description__["']""")
+
+# where the folders inside the .data folder of a wheel are unpacked to,
+# relative to the bundled dependencies. The package folders match pip
+# install --target, but headers go straight to include/ rather than to
+# include/site/pythonX.Y/<dist>/, and unknown folders are dropped.
+WHEEL_DATA_PATHS = {
+    "purelib": "",
+    "platlib": "",
+    "data": "",
+    "scripts": "bin",
+    "headers": "include",
+}
+
+# suffixes of files which are compressed already, and are stored as is
+STORED_SUFFIXES = frozenset({
+    ".whl",
+    ".zip",
+    ".jar",
+    ".nar",
+    ".gz",
+    ".tgz",
+    ".bz2",
+    ".xz",
+    ".zst",
+    ".png",
+    ".jpg",
+    ".jpeg",
+    ".gif",
+    ".webp",
+})
+
+# zlib's own default, used unless `compresslevel` is set under [tool.nar]
+DEFAULT_COMPRESSLEVEL = 6
+
+
+@lru_cache(maxsize=16)
+def _normalize_mode(mode: int) -> int:
+    # only a handful of distinct modes show up in a build,
+    # so they are normalized once each
+    return normalize_file_permissions(mode)
+
+
+def _walk_files(root: str | os.PathLike[str]) -> Iterator[str]:
+    """
+    Yields the paths of all files below root, skipping bytecode caches
+    and, like Path.glob("**/*"), not descending into symlinked folders.
+    """
+    with os.scandir(root) as entries:
+        for entry in entries:
+            if entry.name == "__pycache__":
+                continue
+
+            if entry.is_dir():
+                if not entry.is_symlink():
+                    yield from _walk_files(entry.path)
+                continue
+
+            yield entry.path
+
+
+def _split_requirements(
+    requirements: str,
+) -> tuple[list[str], list[str], list[str]]:
+    """
+    Splits exported requirements into the options for pip, the ones pip
+    downloads an archive for, and the direct references to a folder, a
+    file or a VCS checkout, which pip download saves nothing for.
+    """
+    options: list[str] = []
+    archives: list[str] = []
+    direct: list[str] = []
+
+    # continuation lines, like the hashes, belong to the line before
+    for line in requirements.replace("\\\n", " ").splitlines():
+        line = line.strip()
+
+        if not line or line.startswith("#"):
+            continue
+
+        for prefix in ("-e ", "--editable "):
+            if line.startswith(prefix):
+                # an editable install in the nar would only point back
+                # to the sources, install it like any other requirement
+                direct.append(line[len(prefix) :].strip())
+                break
+        else:
+            if line.startswith("-"):
+                options.append(line)
+            elif " @ " in line.split(";", 1)[0]:
+                direct.append(line)
+            else:
+                archives.append(line)
+
+    return options, archives, direct
+
+
+def _unpack_wheel(wheel: Path, target: Path) -> None:
+    """
+    Unpacks a wheel into target, with its packages laid out like pip
+    install --target does.
+
+    Unlike pip, no launchers are generated for the console scripts of
+    the wheel. pip writes the path of the build's interpreter into them,
+    so they could not run from the nar on the NiFi host anyway.
+    """
+    with ZipFile(wheel) as whl:
+        for info in whl.infolist():
+            path = whl.extract(info, target)
+
+            # extracting drops the mode bits, so restore the executable
+            # bit of scripts and native libraries, as pip does
+            if not info.is_dir() and (info.external_attr >> 16) & 0o111:
+                os.chmod(path, os.stat(path).st_mode | 0o111)
+
+    for data_dir in list(target.glob("*.data")):
+        for scheme_dir in data_dir.iterdir():
+            if scheme_dir.name in WHEEL_DATA_PATHS:
+                _merge_folder(
+                    scheme_dir, target / WHEEL_DATA_PATHS[scheme_dir.name]
+                )
+
+        shutil.rmtree(data_dir)
+
+
+def _merge_folder(src: Path, dst: Path) -> None:
+    """
+    Moves the content of src into dst, merging folders found in both.
+    """
+    dst.mkdir(parents=True, exist_ok=True)
+
+    for entry in src.iterdir():
+        target = dst / entry.name
+
+        if entry.is_dir() and target.is_dir():
+            _merge_folder(entry, target)
+            continue
+
+        if target.is_dir():
+            shutil.rmtree(target)
+
+        os.replace(entry, target)
+
 
 class NarBuilder(Builder):
     format = "nar"
@@ -103,6 +266,32 @@ class NarBuilder(Builder):
             includes=includes,
         )
 
+    @cached_property
+    def _nar_config(self) -> dict[str, Any]:
+        # the file is only read, so there is no need for tomlkit to keep
+        # its formatting, and tomllib is much faster at parsing it
+        with self._poetry.pyproject_path.open("rb") as f:
+            config = tomllib.load(f)
+
+        nar_config: dict[str, Any] = config.get("tool", {}).get("nar", {})
+        return nar_config
+
+    @cached_property
+    def _compresslevel(self) -> int:
+        level = self._nar_config.get("compresslevel", DEFAULT_COMPRESSLEVEL)
+
+        if (
+            isinstance(level, bool)
+            or not isinstance(level, int)
+            or not 0 <= level <= 9
+        ):
+            raise ValueError(
+                f"Invalid compresslevel: {level}, "
+                "expected an integer between 0 and 9"
+            )
+
+        return int(level)
+
     @property
     def filename(self) -> str:
         name = distribution_name(self._package.name)
@@ -118,43 +307,68 @@ class NarBuilder(Builder):
         if not target_dir.exists():
             target_dir.mkdir(parents=True)
 
-        # Create a temporary nar file
-        fd, tmp_file_path = tempfile.mkstemp(suffix=".nar")
+        # an invalid [tool.nar] table raises right away, rather than once
+        # the dependencies, which may take long, are prepared
+        compresslevel = self._compresslevel
 
-        # Normalize permission bits in accord
-        # with poetry WheelBuilder
-        st_mode = os.stat(tmp_file_path).st_mode
-        new_mode = normalize_file_permissions(st_mode)
-        os.chmod(tmp_file_path, new_mode)
-
-        with temporary_directory(prefix=self._package.name) as temp_dir:
-            tmp_package_dir = Path(temp_dir)
-
-            self._copy_module(tmp_package_dir)
-            self._prepare_metadata(tmp_package_dir)
-
-            if self._package.requires:
-                self._prepare_dependencies(target_dir, tmp_package_dir)
-
-            self._dynamic_metadata(tmp_package_dir)
+        # Create the temporary nar file next to the target, so that
+        # moving it in place is a rename within the same filesystem
+        # rather than a copy of the whole file
+        fd, tmp_file_path = tempfile.mkstemp(suffix=".nar", dir=target_dir)
 
+        try:
             with (
                 os.fdopen(fd, "w+b") as fd_file,
-                ZipFile(
-                    fd_file, mode="w", compression=ZIP_DEFLATED
-                ) as zip_file,
+                temporary_directory(prefix=self._package.name) as temp_dir,
+                ThreadPoolExecutor(max_workers=1) as executor,
             ):
-                self._copy_folder(zip_file, tmp_package_dir)
+                tmp_package_dir = Path(temp_dir)
+
+                # only the dependencies are staged, as pip needs a folder
+                # to install them to, everything else is written to the nar
+                # straight from the source. Installing them mostly waits on
+                # pip, so it runs in the background meanwhile. The worker
+                # only writes to the staging folder, the ZipFile is only
+                # ever used from this thread.
+                deps = (
+                    executor.submit(
+                        self._prepare_dependencies,
+                        target_dir,
+                        tmp_package_dir,
+                    )
+                    if self._package.requires
+                    else None
+                )
+
+                with ZipFile(
+                    fd_file,
+                    mode="w",
+                    compression=ZIP_DEFLATED,
+                    compresslevel=compresslevel,
+                ) as zip_file:
+                    self._prepare_metadata(zip_file)
+                    self._copy_module(zip_file)
+
+                    if deps is not None:
+                        # re-raises any error from preparing them
+                        deps.result()
+                        self._copy_folder(zip_file, tmp_package_dir)
+        except BaseException:
+            # don't leave a partial nar behind in the target folder
+            os.remove(tmp_file_path)
+            raise
 
         # target file path
         target = target_dir / self.filename
 
-        # if the target file already exists, remove it
-        if target.exists():
-            target.unlink()
+        # move the temporary nar file to the target path,
+        # replacing the target file if it already exists
+        os.replace(tmp_file_path, target)
 
-        # rename and move the temporary nar file to the target path
-        shutil.move(tmp_file_path, target)
+        # mkstemp creates the file readable by its owner only, so
+        # normalize the permission bits in accord with poetry
+        # WheelBuilder, once the file is in place
+        os.chmod(target, 0o644)
 
         logger.info(f"Built <comment>{self.filename}</comment>")
         return target
@@ -164,11 +378,22 @@ class NarBuilder(Builder):
     ) -> set[BuildIncludeFile]:
         """
         Finds all files to add to the nar package.
+
+        The source tree is only walked once per builder, later calls
+        reuse the files found by the first one.
         """
+        return set(self._files_to_add)
+
+    @cached_property
+    def _files_to_add(self) -> tuple[BuildIncludeFile, ...]:
         from poetry.core.masonry.utils.package_include import PackageInclude
 
         to_add = set()
 
+        # directories are collected first, so that they can be walked
+        # concurrently once all of them are known
+        to_walk: list[tuple[Path, Path, str | None]] = []
+
         for include in self._module.includes:
             include.refresh()
             formats = include.formats or ["nar"]
@@ -197,21 +422,7 @@ class NarBuilder(Builder):
 
                 if file.is_dir():
                     if self.format in formats:
-                        for current_file in file.glob("**/*"):
-                            include_file = BuildIncludeFile(
-                                path=current_file,
-                                project_root=self._path,
-                                source_root=source_root,
-                                target_dir=target_dir,
-                            )
-
-                            if not (
-                                current_file.is_dir()
-                                or self.is_excluded(
-                                    include_file.relative_to_source_root()
-                                )
-                            ):
-                                to_add.add(include_file)
+                        to_walk.append((file, source_root, target_dir))
                     continue
 
                 include_file = BuildIncludeFile(
@@ -232,74 +443,120 @@ class NarBuilder(Builder):
                 logger.debug(f"Adding: {file}")
                 to_add.add(include_file)
 
-        return to_add
+        # the walk is bound by filesystem latency, and scandir releases
+        # the GIL while waiting on it, so threads overlap the waits
+        with ThreadPoolExecutor() as executor:
+            walked = executor.map(lambda x: list(_walk_files(x[0])), to_walk)
 
-    def _copy_module(self, nar_package_dir: Path) -> None:
-        to_add = self.find_files_to_add()
+            for (_, source_root, target_dir), files in zip(to_walk, walked):
+                for current_file in files:
+                    include_file = BuildIncludeFile(
+                        path=current_file,
+                        project_root=self._path,
+                        source_root=source_root,
+                        target_dir=target_dir,
+                    )
+
+                    if not self.is_excluded(
+                        include_file.relative_to_source_root()
+                    ):
+                        to_add.add(include_file)
+
+        # sorting everything once so the order is stable
+        # for every caller, without sorting it again
+        return tuple(sorted(to_add, key=attrgetter("path")))
+
+    @cached_property
+    def _files_by_project_path(self) -> dict[Path, BuildIncludeFile]:
+        return {
+            file.relative_to_project_root(): file
+            for file in self._files_to_add
+        }
+
+    def _copy_module(self, nar: ZipFile) -> None:
+        updated = self._dynamic_metadata()
+
+        for file in self._files_to_add:
+            self._add_file(
+                nar,
+                file.path,
+                file.relative_to_target_root(),
+                content=updated.get(file.path),
+            )
 
-        # sorting everything so the order is stable.
-        for file in sorted(to_add, key=lambda x: x.path):
-            dst = nar_package_dir / file.relative_to_target_root()
-            dst.parent.mkdir(parents=True, exist_ok=True)
+    def _prepare_metadata(self, nar: ZipFile) -> None:
+        # Write the MANIFEST.MF file first, as jar readers expect
+        manifest = MANIFEST_BASE.format(
+            timestamp=datetime.now(timezone.utc).strftime(
+                "%Y-%m-%dT%H:%M:%SZ"
+            ),
+            name=self._meta.name,
+            version=self._meta.version,
+        )
 
-            shutil.copy2(file.path, dst)
+        self._add_folder(nar, Path("META-INF"))
 
-    def _prepare_metadata(self, nar_package_dir: Path) -> None:
-        # Create the metadata directory
-        metadata_dir = nar_package_dir / "META-INF"
-        metadata_dir.mkdir()
+        zip_info = ZipInfo("META-INF/MANIFEST.MF")
+        # a regular file with 644 permissions, as files are normalized to
+        zip_info.external_attr = (stat.S_IFREG | 0o644) << 16
+        nar.writestr(
+            zip_info,
+            manifest.encode("utf-8"),
+            compress_type=ZIP_DEFLATED,
+            compresslevel=self._compresslevel,
+        )
 
         # Copy the legal files
-        for legal_file in self._get_legal_files():
+        for legal_file in sorted(self._get_legal_files()):
             if not legal_file.is_file():
                 logger.debug(f"Skipping: {legal_file.as_posix()}")
                 continue
 
-            dest = metadata_dir / legal_file.relative_to(self._path)
-            dest.parent.mkdir(parents=True, exist_ok=True)
-            shutil.copy2(legal_file, dest)
+            self._add_file(
+                nar,
+                legal_file,
+                Path("META-INF") / legal_file.relative_to(self._path),
+            )
 
         # Copy readme file/s if mentioned in pyproject.toml
         if "readme" in self._poetry.local_config:
             readme: str | Iterable[str] = self._poetry.local_config["readme"]
 
             if isinstance(readme, str):
+                readme = [readme]
+
+            for r in readme:
                 file = BuildIncludeFile(
-                    path=readme,
+                    path=r,
                     project_root=self._path,
                     source_root=self._path,
                 )
-                shutil.copy2(file.path, metadata_dir / Path(readme).name)
-            else:
-                for r in readme:
-                    file = BuildIncludeFile(
-                        path=r,
-                        project_root=self._path,
-                        source_root=self._path,
-                    )
-                    shutil.copy2(file.path, metadata_dir / Path(r).name)
-
-        # Write the MANIFEST.MF file
-        with open(
-            f"{metadata_dir}/MANIFEST.MF", "w", encoding="utf-8", newline="\n"
-        ) as f:
-            f.write(
-                MANIFEST_BASE.format(
-                    timestamp=datetime.now(timezone.utc).strftime(
-                        "%Y-%m-%dT%H:%M:%SZ"
-                    ),
-                    name=self._meta.name,
-                    version=self._meta.version,
+                self._add_file(
+                    nar, file.path, Path("META-INF") / Path(r).name
                 )
-            )
 
     def _copy_folder(self, nar: ZipFile, nar_package_dir: Path) -> None:
-        for file in sorted(nar_package_dir.glob("**/*")):
-            if not (file.is_file() or file.is_dir()):
-                continue
+        # os.walk lists each folder with a single scandir call,
+        # instead of building and globbing a Path for every entry
+        for dirpath, dirnames, filenames in os.walk(nar_package_dir):
+            # sorting everything so the order is stable, sorting the
+            # folders in place also makes os.walk descend in that order
+            dirnames.sort()
+            filenames.sort()
 
-            target_path = file.relative_to(nar_package_dir)
-            self._add_file(nar, file, target_path)
+            folder = Path(dirpath)
+            target_folder = folder.relative_to(nar_package_dir)
+
+            self._add_folder(nar, target_folder)
+
+            for name in filenames:
+                file = folder / name
+
+                # a broken symlink, which is not added
+                if os.path.islink(file) and not os.path.exists(file):
+                    continue
+
+                self._add_file(nar, file, target_folder / name)
 
     def _prepare_dependencies(
         self, target_dir: Path, nar_package_dir: Path
@@ -308,138 +565,264 @@ class NarBuilder(Builder):
         fd, tmp_file_path = tempfile.mkstemp(suffix=".txt")
 
         try:
-            # command to export the requirements to a requirements.txt file
-            command = [
-                "poetry",
-                "export",
-                "-f",
-                "requirements.txt",
-                "-o",
-                tmp_file_path,
-            ]
+            poetry = cast("Poetry", self._poetry)
 
-            self._execute_command(command)
+            # exporting needs a lock file, and creating one takes a full
+            # dependency resolution, which is left to poetry itself
+            if not poetry.locker.is_locked():
+                self._execute_command(["poetry", "lock", "--no-update"])
 
-            # directory to store the pip cache
-            cache_dir = target_dir / "pip-cache"
+            # export the requirements to a requirements.txt file in-process,
+            # rather than starting another poetry just to read the lock file
+            Exporter(poetry, NullIO()).export(
+                "requirements.txt", self._path, tmp_file_path
+            )
 
-            if not cache_dir.exists():
-                cache_dir.mkdir()
+            cache_dir = self._pip_cache_dir(target_dir)
+            cache_dir.mkdir(parents=True, exist_ok=True)
 
             # directory to unpack the dependencies
             deps_dir = nar_package_dir / "NAR-INF" / "bundled-dependencies"
             deps_dir.mkdir(parents=True)
 
-            # command to download the dependencies
-            # to the dependency unpack directory
-            command = [
-                str(self.executable),
-                "-m",
-                "pip",
-                "install",
-                "-r",
-                tmp_file_path,
-                "--upgrade",
-                "--no-python-version-warning",
-                "--no-input",
-                "--cache-dir",
-                str(cache_dir),
-                "--quiet",
-                "--target",
-                str(deps_dir),
-            ]
-
-            self._execute_command(command)
+            # the version check is also disabled through the environment,
+            # so that it reaches the pip runs that install build backends
+            # for source distributions in isolated environments
+            pip_env = {**os.environ, "PIP_DISABLE_PIP_VERSION_CHECK": "1"}
+
+            options, requirements, direct = _split_requirements(
+                Path(tmp_file_path).read_text(encoding="utf-8")
+            )
+
+            with temporary_directory(prefix="nar-downloads") as temp_dir:
+                download_dir = Path(temp_dir) / "archives"
+                download_dir.mkdir()
+
+                if requirements:
+                    requirements_file = Path(temp_dir) / "archives.txt"
+                    requirements_file.write_text(
+                        "\n".join([*options, *requirements]) + "\n",
+                        encoding="utf-8",
+                    )
+
+                    # command to download the archives of all the locked
+                    # dependencies, which are resolved already, so pip
+                    # doesn't need to look for their dependencies
+                    command = [
+                        str(self.executable),
+                        "-m",
+                        "pip",
+                        "download",
+                        "-r",
+                        str(requirements_file),
+                        "--no-deps",
+                        "--no-python-version-warning",
+                        "--disable-pip-version-check",
+                        "--no-input",
+                        "--cache-dir",
+                        str(cache_dir),
+                        "--quiet",
+                        "--dest",
+                        str(download_dir),
+                    ]
+
+                    self._execute_command(command, env=pip_env)
+
+                archives = sorted(download_dir.iterdir())
+                wheels = [a for a in archives if a.suffix == ".whl"]
+                sdists = [a for a in archives if a.suffix != ".whl"]
+
+                # the direct references are kept in a file of their own,
+                # as they have no hashes, which pip requires for every
+                # requirement of a file once one of them has any
+                direct_args: list[str] = []
+
+                if direct:
+                    direct_file = Path(temp_dir) / "direct.txt"
+                    direct_file.write_text(
+                        "\n".join([*options, *direct]) + "\n",
+                        encoding="utf-8",
+                    )
+                    direct_args = ["-r", str(direct_file)]
+
+                # source distributions and direct references have to be
+                # built first, which is left to pip
+                if sdists or direct:
+                    command = [
+                        str(self.executable),
+                        "-m",
+                        "pip",
+                        "install",
+                        *map(str, sdists),
+                        *direct_args,
+                        "--no-deps",
+                        "--upgrade",
+                        "--no-python-version-warning",
+                        "--disable-pip-version-check",
+                        "--no-input",
+                        "--cache-dir",
+                        str(cache_dir),
+                        "--quiet",
+                        "--target",
+                        str(deps_dir),
+                    ]
+
+                    self._execute_command(command, env=pip_env)
+
+                # wheels only need unpacking, each into a folder of its
+                # own so they can't race on folders shared between them,
+                # like namespace packages, which are merged afterwards
+                unpack_dirs = [
+                    Path(temp_dir) / "unpacked" / w.stem for w in wheels
+                ]
+
+                with ThreadPoolExecutor() as executor:
+                    list(executor.map(_unpack_wheel, wheels, unpack_dirs))
+
+                for unpack_dir in unpack_dirs:
+                    _merge_folder(unpack_dir, deps_dir)
         finally:
             os.close(fd)
             os.remove(tmp_file_path)
 
-    def _execute_command(self, command: list[str]) -> None:
-        # run the command to export the requirements
-        check_call(command, stdout=PIPE, stderr=PIPE, cwd=self._path)
+    def _pip_cache_dir(self, target_dir: Path) -> Path:
+        # directory to store the pip cache
+        return target_dir / "pip-cache"
+
+    def _execute_command(
+        self, command: list[str], env: dict[str, str] | None = None
+    ) -> None:
+        # run the command from the project root
+        check_call(command, stdout=PIPE, stderr=PIPE, cwd=self._path, env=env)
+
+    def _add_folder(self, nar: ZipFile, rel_path: Path) -> None:
+        """
+        Adds an entry for the folder rel_path, and for each of its parents,
+        unless the nar has one already. Parents are added first, as the
+        jar tools NiFi reads the nar with lay them out.
+        """
+        if not rel_path.parts:
+            # the root of the nar has no entry
+            return
+
+        # every parent but the root, top down, then the folder itself
+        folders = [*reversed(list(rel_path.parents)[:-1]), rel_path]
+
+        for folder in folders:
+            name = folder.as_posix() + "/"
+
+            if name in nar.NameToInfo:
+                continue
+
+            zip_info = ZipInfo(name)
+            # folders are normalized to 755, like in poetry WheelBuilder
+            zip_info.external_attr = (stat.S_IFDIR | 0o755) << 16
+            zip_info.external_attr |= 0x10  # MS-DOS directory flag
+
+            nar.writestr(zip_info, b"")
 
     def _add_file(
-        self, nar: ZipFile, full_path: Path, rel_path: Path
+        self,
+        nar: ZipFile,
+        full_path: Path,
+        rel_path: Path,
+        content: bytes | None = None,
     ) -> None:
-        # We always want to have /-separated paths
-        # in the zip file and in RECORD
-        rel_path_name = (
-            rel_path.as_posix()
-            if full_path.is_file()
-            else rel_path.as_posix() + "/"
+        # from_file stats the file once, and fills in its size, its mode
+        # and a /-separated name, ending in / for folders, from that
+        zip_info = ZipInfo.from_file(
+            full_path, arcname=rel_path, strict_timestamps=False
         )
-        zip_info = ZipInfo(rel_path_name)
+
+        if zip_info.is_dir():
+            self._add_folder(nar, rel_path)
+            return
+
+        # the entries of the parent folders come before their first file
+        self._add_folder(nar, rel_path.parent)
+
+        # keep the fixed timestamp of a bare ZipInfo,
+        # so that builds stay reproducible
+        zip_info.date_time = (1980, 1, 1, 0, 0, 0)
 
         # Normalize permission bits to either 755 (executable) or 644
-        st_mode = full_path.stat().st_mode
-        new_mode = normalize_file_permissions(st_mode)
-        zip_info.external_attr = (new_mode & 0xFFFF) << 16  # Unix attributes
+        new_mode = _normalize_mode(zip_info.external_attr >> 16)
+        zip_info.external_attr = (new_mode & 0xFFFF) << 16
 
-        if stat.S_ISDIR(st_mode):
-            zip_info.external_attr |= 0x10  # MS-DOS directory flag
+        if full_path.suffix.lower() in STORED_SUFFIXES:
+            # already compressed files hardly get any smaller,
+            # so they are stored as is instead of deflated again
+            zip_info.compress_type = ZIP_STORED
+        else:
+            zip_info.compress_type = ZIP_DEFLATED
+
+            # ZipFile only applies its compresslevel to the entries
+            # it creates itself, so set it on the ZipInfo explicitly
+            if sys.version_info >= (3, 13):
+                zip_info.compress_level = self._compresslevel
+            else:
+                zip_info._compresslevel = self._compresslevel  # type: ignore[attr-defined]
 
-        if full_path.is_dir():
-            nar.writestr(zip_info, "")
+        if content is not None:
+            # the file was rewritten in memory, add that instead
+            nar.writestr(zip_info, content)
         else:
-            with full_path.open("rb") as src:
-                src.seek(0)
-                nar.writestr(zip_info, src.read(), compress_type=ZIP_DEFLATED)
+            # Stream the file into the archive in fixed-size chunks, so
+            # the memory used does not grow with the size of the file.
+            # The size is known beforehand, which lets zipfile decide
+            # whether the entry needs zip64 extensions.
+            with (
+                full_path.open("rb") as src,
+                nar.open(zip_info, mode="w") as dst,
+            ):
+                shutil.copyfileobj(src, dst, COPY_BUFFER_SIZE)
 
-    def _dynamic_metadata(self, nar_package_dir: Path) -> None:
-        config = tomlkit.parse(
-            self._poetry.pyproject_path.read_bytes().decode()
-        )
+    def _dynamic_metadata(self) -> dict[Path, bytes]:
+        """
+        Returns the contents of the module files with dynamic metadata
+        filled in, keyed by the path of the source file.
+        """
+        # files are kept decoded until all updates are applied, so a
+        # file holding both placeholders is only decoded and encoded once
+        updated: dict[Path, str] = {}
 
-        version = config.get("tool", {}).get("nar", {}).get("version", None)
-        description = (
-            config.get("tool", {}).get("nar", {}).get("description", None)
-        )
+        version = self._nar_config.get("version", None)
+        description = self._nar_config.get("description", None)
 
         if version is not None:
             self._apply_dynamic_update(
                 Path(version),
-                nar_package_dir,
-                r"version(?:\s+|)=(?:\s+|)?[\"']__version__[\"']",
+                updated,
+                VERSION_RE,
                 f'version = "{self._package.version}"',
             )
 
         if description is not None:
             self._apply_dynamic_update(
                 Path(description),
-                nar_package_dir,
-                r"description(?:\s+|)=(?:\s+|)?[\"']__description__[\"']",
+                updated,
+                DESCRIPTION_RE,
                 f'description = "{self._package.description}"',
             )
 
+        return {path: text.encode("utf-8") for path, text in updated.items()}
+
     def _apply_dynamic_update(
         self,
         file_path: Path,
-        nar_package_dir: Path,
-        pattern: str,
+        updated: dict[Path, str],
+        pattern: re.Pattern[str],
         replace: str,
     ) -> None:
-        files = self.find_files_to_add()
-
-        flag = False
+        file = self._files_by_project_path.get(file_path)
 
-        # sorting everything so the order is stable.
-        for file in sorted(files, key=lambda x: x.path):
-            if file.relative_to_project_root() == file_path:
-                flag = True
-                x = nar_package_dir / file.relative_to_target_root()
-
-                with x.open("r+b") as src:
-                    lines = re.sub(
-                        pattern,
-                        replace,
-                        src.read().decode(),
-                    )
-
-                    src.seek(0)
-                    src.write(lines.encode())
-                    src.truncate()
+        if file is None:
+            logger.warning(f"File {file_path} not found in the package")
+            return
 
-                break
+        # continue from an earlier update of the same file
+        text = updated.get(file.path)
+        if text is None:
+            text = file.path.read_bytes().decode("utf-8")
 
-        if not flag:
-            logger.warning(f"File {file_path} not found in the package")
+        updated[file.path] = pattern.sub(replace, text)
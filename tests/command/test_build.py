@@ -4,21 +4,23 @@
 
 from __future__ import annotations
 
+import os
 import shutil
 import tarfile
 
+from pathlib import Path
 from typing import TYPE_CHECKING
 
 import pytest
 
-from poetry.core.masonry.utils.helpers import distribution_name
 from poetry.utils.env import EnvManager
 from poetry.utils.env import VirtualEnv
 
+from tests.helpers import dist_name
+
 
 if TYPE_CHECKING:
     from collections.abc import Iterator
-    from pathlib import Path
 
     from cleo.testers.command_tester import CommandTester
     from poetry.poetry import Poetry
@@ -26,10 +28,11 @@ if TYPE_CHECKING:
     from tests.types import CommandTesterFactory
 
 
-def get_package_glob(poetry: Poetry) -> str:
-    return (
-        f"{distribution_name(poetry.package.name)}-{poetry.package.version}*"
-    )
+def get_build_artifacts(poetry: Poetry, build_dir: Path) -> list[Path]:
+    prefix = f"{dist_name(poetry.package.name)}-{poetry.package.version}"
+
+    with os.scandir(build_dir) as it:
+        return [Path(e.path) for e in it if e.name.startswith(prefix)]
 
 
 @pytest.fixture
@@ -39,9 +42,12 @@ def tmp_tester(
     return command_tester_factory("build", poetry)
 
 
-@pytest.fixture
-def tmp_venv(tmp_path: Path) -> Iterator[VirtualEnv]:
-    venv_path = tmp_path / "venv"
+@pytest.fixture(scope="session")
+def tmp_venv(
+    tmp_path_factory: pytest.TempPathFactory,
+) -> Iterator[VirtualEnv]:
+    # building a venv with pip is slow, the tests only read from it
+    venv_path = tmp_path_factory.mktemp("venv", numbered=False)
 
     EnvManager.build_venv(venv_path, with_pip=True)
 
@@ -85,9 +91,7 @@ def test_build_creates_packages(
     format: str,
 ) -> None:
     tmp_tester.execute(f"--format {format}")
-    build_artifacts = tuple(
-        (project_dir / "dist").glob(get_package_glob(poetry))
-    )
+    build_artifacts = get_build_artifacts(poetry, project_dir / "dist")
     assert len(build_artifacts) == 2 if format == "all" else 1
     assert all(archive.exists() for archive in build_artifacts)
 
@@ -103,6 +107,7 @@ def test_build_not_possible_in_non_package_mode(
     )
 
 
+@pytest.mark.venv
 @pytest.mark.parametrize("project", ["multiple-readme"])
 def test_build_with_multiple_readme_files(
     poetry: Poetry,
@@ -116,7 +121,7 @@ def test_build_with_multiple_readme_files(
     build_dir = project_dir / "dist"
     assert build_dir.exists()
 
-    name = distribution_name(poetry.package.name)
+    name = dist_name(poetry.package.name)
     filename = f"{name}-{poetry.package.version}"
 
     sdist_file = build_dir / f"{filename}.tar.gz"
@@ -127,11 +132,19 @@ def test_build_with_multiple_readme_files(
     assert wheel_file.exists()
     assert wheel_file.stat().st_size > 0
 
+    targets = {f"{filename}/README-1.md", f"{filename}/README-2.md"}
+    found = set()
+
+    # stop reading the archive as soon as both readme files are seen
     with tarfile.open(sdist_file) as tf:
-        sdist_content = tf.getnames()
+        for info in tf:
+            if info.name in targets:
+                found.add(info.name)
+
+                if found == targets:
+                    break
 
-    assert f"{filename}/README-1.md" in sdist_content
-    assert f"{filename}/README-2.md" in sdist_content
+    assert found == targets
 
 
 @pytest.mark.parametrize(
@@ -161,6 +174,6 @@ def test_build_output_option(
         tmp_tester.execute(f"-f {format} -o {output_dir}")
         build_dir = project_dir / output_dir
 
-    build_artifacts = tuple(build_dir.glob(get_package_glob(poetry)))
+    build_artifacts = get_build_artifacts(poetry, build_dir)
     assert len(build_artifacts) == 2 if format == "all" else 1
     assert all(archive.exists() for archive in build_artifacts)
@@ -4,6 +4,7 @@
 
 from __future__ import annotations
 
+import os
 import shutil
 
 from pathlib import Path
@@ -19,6 +20,8 @@ from tests.helpers import PoetryTestApplication
 
 
 if TYPE_CHECKING:
+    from collections.abc import Iterator
+
     from poetry.poetry import Poetry
     from pytest_mock.plugin import MockerFixture
 
@@ -26,27 +29,64 @@ if TYPE_CHECKING:
     from tests.types import ProjectFactory
 
 
+def _fast_clone(src: Path, dst: Path) -> None:
+    def _link(source: str, target: str) -> str:
+        # poetry may rewrite the pyproject.toml, never share it with the
+        # fixture
+        if os.path.basename(source) != "pyproject.toml":
+            try:
+                os.link(source, target)
+                return target
+            except OSError:
+                # e.g. EXDEV, the fixtures and tmp dir are on different
+                # devices, or a filesystem without hardlinks
+                pass
+
+        shutil.copy2(source, target)
+        return target
+
+    shutil.copytree(src, dst, copy_function=_link)
+
+
 @pytest.fixture
 def project_dir(tmp_path: Path, project: str) -> Path:
     return tmp_path / project
 
 
-@pytest.fixture
+# session scoped fixtures are created once per pytest-xdist worker, they
+# must not hold state that one test can change under another.
+@pytest.fixture(scope="session")
 def auth_config_source() -> DictConfigSource:
     source = DictConfigSource()
 
     return source
 
 
-@pytest.fixture
-def config_cache_dir(tmp_path: Path) -> Path:
-    path = tmp_path / ".cache" / "pypoetry"
-    path.mkdir(parents=True)
+@pytest.fixture(scope="session")
+def config_cache_dir(tmp_path_factory: pytest.TempPathFactory) -> Path:
+    base = tmp_path_factory.getbasetemp()
+
+    # each xdist worker gets a folder of its own in the base temp dir of
+    # the session, the cache goes next to them so the workers share it
+    if "PYTEST_XDIST_WORKER" in os.environ:
+        base = base.parent
+
+    path = base / "poetry-cache"
+    path.mkdir(exist_ok=True)
 
     return path
 
 
-@pytest.fixture
+@pytest.fixture(scope="session", autouse=True)
+def cache_env(config_cache_dir: Path) -> Iterator[None]:
+    # the cache of the poetry lock run started by the builder
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setenv("POETRY_CACHE_DIR", str(config_cache_dir))
+
+        yield
+
+
+@pytest.fixture(scope="session")
 def config_source(config_cache_dir: Path) -> DictConfigSource:
     source = DictConfigSource()
     source.add_property("cache-dir", str(config_cache_dir))
@@ -54,11 +94,10 @@ def config_source(config_cache_dir: Path) -> DictConfigSource:
     return source
 
 
-@pytest.fixture
-def config(
+@pytest.fixture(scope="session")
+def session_config(
     config_source: DictConfigSource,
     auth_config_source: DictConfigSource,
-    mocker: MockerFixture,
 ) -> Config:
     import keyring
 
@@ -71,10 +110,19 @@ def config(
     c.set_config_source(config_source)
     c.set_auth_config_source(auth_config_source)
 
-    mocker.patch("poetry.config.config.Config.create", return_value=c)
+    return c
+
+
+@pytest.fixture
+def config(session_config: Config, mocker: MockerFixture) -> Config:
+    # the config is built once per session, only the patches,
+    # which pytest-mock undoes after every test, are per test
+    mocker.patch(
+        "poetry.config.config.Config.create", return_value=session_config
+    )
     mocker.patch("poetry.config.config.Config.set_config_source")
 
-    return c
+    return session_config
 
 
 @pytest.fixture
@@ -86,7 +134,7 @@ def project_factory(
         source: Path,
     ) -> Poetry:
         project_dir.parent.mkdir(parents=True, exist_ok=True)
-        shutil.copytree(source, project_dir)
+        _fast_clone(source, project_dir)
 
         poetry = Factory().create_poetry(project_dir)
         poetry.set_config(config)
@@ -109,13 +157,32 @@ def fixture_dir(fixture_base: Path) -> FixtureDirGetter:
     return _fixture_dir
 
 
+@pytest.fixture(scope="session")
+def fixture_template(
+    fixture_dir: FixtureDirGetter, tmp_path_factory: pytest.TempPathFactory
+) -> FixtureDirGetter:
+    # copy every fixture once per session into the base temp directory, so
+    # the per test clones can hardlink from the same filesystem
+    templates: dict[str, Path] = {}
+
+    def _fixture_template(name: str) -> Path:
+        if name not in templates:
+            template = tmp_path_factory.mktemp("templates") / name
+            shutil.copytree(fixture_dir(name), template)
+            templates[name] = template
+
+        return templates[name]
+
+    return _fixture_template
+
+
 @pytest.fixture
 def poetry(
     project: str,
     project_factory: ProjectFactory,
-    fixture_dir: FixtureDirGetter,
+    fixture_template: FixtureDirGetter,
 ) -> Poetry:
-    return project_factory(source=fixture_dir(project))
+    return project_factory(source=fixture_template(project))
 
 
 @pytest.fixture
@@ -4,38 +4,92 @@
 
 from __future__ import annotations
 
+import contextlib
+import functools
+
 from typing import TYPE_CHECKING
+from zipfile import ZipFile
 
 from poetry.config.config import Config as BaseConfig
 from poetry.console.application import Application
+from poetry.core.masonry.utils.helpers import distribution_name
 from poetry.factory import Factory
 from poetry.installation.executor import Executor
 
 
 if TYPE_CHECKING:
+    from collections.abc import Iterator
+    from pathlib import Path
     from typing import Any
+    from zipfile import ZipInfo
 
+    from packaging.utils import NormalizedName
+    from poetry.config.config_source import ConfigSource
     from poetry.core.packages.package import Package
     from poetry.installation.operations.operation import Operation
     from poetry.poetry import Poetry
 
 
+@functools.lru_cache(maxsize=None)
+def dist_name(name: NormalizedName) -> str:
+    return distribution_name(name)
+
+
+@contextlib.contextmanager
+def open_nar(path: Path) -> Iterator[tuple[ZipFile, dict[str, ZipInfo]]]:
+    # index the entries once, instead of scanning namelist() per assertion
+    with ZipFile(path, "r") as zf:
+        infos = {zi.filename: zi for zi in zf.infolist()}
+
+        yield zf, infos
+
+
 class Config(BaseConfig):
-    def get(self, setting_name: str, default: Any = None) -> Any:
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+
+        # the sources are merged only after they have been replaced, or
+        # after a test that changes them in place says so with invalidate()
+        self._dirty = True
+
+    def set_config_source(self, config_source: ConfigSource) -> Config:
+        self._dirty = True
+
+        super().set_config_source(config_source)
+
+        return self
+
+    def set_auth_config_source(self, config_source: ConfigSource) -> Config:
+        self._dirty = True
+
+        super().set_auth_config_source(config_source)
+
+        return self
+
+    def invalidate(self) -> None:
+        self._dirty = True
+
+    def _merge_sources(self) -> None:
+        if not self._dirty:
+            return
+
         self.merge(self._config_source.config)  # type: ignore[attr-defined]
         self.merge(self._auth_config_source.config)  # type: ignore[attr-defined]
 
+        self._dirty = False
+
+    def get(self, setting_name: str, default: Any = None) -> Any:
+        self._merge_sources()
+
         return super().get(setting_name, default=default)
 
     def raw(self) -> dict[str, Any]:
-        self.merge(self._config_source.config)  # type: ignore[attr-defined]
-        self.merge(self._auth_config_source.config)  # type: ignore[attr-defined]
+        self._merge_sources()
 
         return super().raw()
 
     def all(self) -> dict[str, Any]:
-        self.merge(self._config_source.config)  # type: ignore[attr-defined]
-        self.merge(self._auth_config_source.config)  # type: ignore[attr-defined]
+        self._merge_sources()
 
         return super().all()
 
@@ -54,9 +108,20 @@ class PoetryTestApplication(Application):
 
 
 class TestExecutor(Executor):
-    def __init__(self, *args: Any, **kwargs: Any) -> None:
+    _OP_TABLE = {
+        "install": "_installs",
+        "update": "_updates",
+        "uninstall": "_uninstalls",
+    }
+
+    def __init__(
+        self, *args: Any, collect: bool = True, **kwargs: Any
+    ) -> None:
         super().__init__(*args, **kwargs)
 
+        # tests that never read the packages below can opt out of
+        # recording them
+        self._collect = collect
         self._installs: list[Package] = []
         self._updates: list[Package] = []
         self._uninstalls: list[Package] = []
@@ -76,8 +141,10 @@ class TestExecutor(Executor):
     def _do_execute_operation(self, operation: Operation) -> int:
         rc = super()._do_execute_operation(operation)
 
-        if not operation.skipped:
-            getattr(self, f"_{operation.job_type}s").append(operation.package)
+        if self._collect and not operation.skipped:
+            getattr(self, self._OP_TABLE[operation.job_type]).append(
+                operation.package
+            )
 
         return rc
 
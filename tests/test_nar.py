@@ -4,22 +4,32 @@
 
 from __future__ import annotations
 
+import os
 import re
+import shutil
+import sys
 
+from pathlib import Path
+from subprocess import CalledProcessError
 from typing import TYPE_CHECKING
+from zipfile import ZIP_DEFLATED
+from zipfile import ZIP_STORED
 from zipfile import ZipFile
+from zipfile import ZipInfo
 
 import pytest
 
-from poetry.core.masonry.utils.helpers import distribution_name
-
 from poetry_plugin_nar.nar import NarBuilder
+from poetry_plugin_nar.nar import _merge_folder
+from poetry_plugin_nar.nar import _unpack_wheel
 
+from tests.helpers import dist_name
+from tests.helpers import open_nar
 
-if TYPE_CHECKING:
-    from pathlib import Path
 
+if TYPE_CHECKING:
     from poetry.poetry import Poetry
+    from pytest_mock import MockerFixture
 
     from tests.types import FixtureDirGetter
     from tests.types import ProjectFactory
@@ -29,17 +39,15 @@ if TYPE_CHECKING:
 def test_build_package_manifest(poetry: Poetry, project_dir: Path) -> None:
     NarBuilder(poetry).build()
 
-    name = distribution_name(poetry.package.name)
+    name = dist_name(poetry.package.name)
     nar = project_dir / "dist" / f"{name}-{poetry.package.version}.nar"
 
     assert nar.exists()
 
-    with ZipFile(nar, "r") as file:
-        file.testzip()
+    with open_nar(nar) as (file, infos):
+        assert "META-INF/MANIFEST.MF" in infos
 
-        assert "META-INF/MANIFEST.MF" in file.namelist()
-
-        manifest = file.read("META-INF/MANIFEST.MF").decode()
+        manifest = file.read(infos["META-INF/MANIFEST.MF"]).decode()
 
         assert "Manifest-Version: 1.0" in manifest
         assert "Created-By: poetry-plugin-nar" in manifest
@@ -65,7 +73,7 @@ def test_build_package_target_dir(
         target_dir=project_dir / target_dir if target_dir else None
     )
 
-    name = distribution_name(poetry.package.name)
+    name = dist_name(poetry.package.name)
     nar = (
         project_dir / target_dir if target_dir else project_dir / "dist"
     ) / f"{name}-{poetry.package.version}.nar"
@@ -79,65 +87,69 @@ def test_build_package_from_packages(
 ) -> None:
     NarBuilder(poetry).build()
 
-    name = distribution_name(poetry.package.name)
+    name = dist_name(poetry.package.name)
     nar = project_dir / "dist" / f"{name}-{poetry.package.version}.nar"
 
     assert nar.exists()
 
-    with ZipFile(nar, "r") as file:
-        file.testzip()
-
-        assert f"{name}/__init__.py" in file.namelist()
+    with open_nar(nar) as (file, infos):
+        assert f"{name}/__init__.py" in infos
 
 
 @pytest.mark.parametrize("project", ["multiple-readme"])
 def test_build_multiple_readme(poetry: Poetry, project_dir: Path) -> None:
     NarBuilder(poetry).build()
 
-    name = distribution_name(poetry.package.name)
+    name = dist_name(poetry.package.name)
     nar = project_dir / "dist" / f"{name}-{poetry.package.version}.nar"
 
     assert nar.exists()
 
-    with ZipFile(nar, "r") as file:
-        file.testzip()
-
-        assert "META-INF/README-1.md" in file.namelist()
-        assert "META-INF/README-2.md" in file.namelist()
+    with open_nar(nar) as (file, infos):
+        assert "META-INF/README-1.md" in infos
+        assert "META-INF/README-2.md" in infos
 
 
 @pytest.mark.parametrize("project", ["package-with-license"])
 def test_build_with_license(poetry: Poetry, project_dir: Path) -> None:
     NarBuilder(poetry).build()
 
-    name = distribution_name(poetry.package.name)
+    name = dist_name(poetry.package.name)
     nar = project_dir / "dist" / f"{name}-{poetry.package.version}.nar"
 
     assert nar.exists()
 
-    with ZipFile(nar, "r") as file:
-        file.testzip()
+    with open_nar(nar) as (file, infos):
+        assert "META-INF/LICENSE" in infos
+
 
-        assert "META-INF/LICENSE" in file.namelist()
+@pytest.fixture
+def shared_pip_cache(config_cache_dir: Path, mocker: MockerFixture) -> None:
+    # the pip cache of the builder is in the build folder, which is new
+    # for every test, use the cache of the session instead
+    mocker.patch.object(
+        NarBuilder, "_pip_cache_dir", return_value=config_cache_dir / "pip"
+    )
 
 
+@pytest.mark.slow
+@pytest.mark.xdist_group("dependency")
+@pytest.mark.usefixtures("shared_pip_cache")
 @pytest.mark.parametrize("project", ["write-numpy-version"])
 def test_build_package_with_dependency(
     poetry: Poetry, project_dir: Path
 ) -> None:
     NarBuilder(poetry).build()
 
-    name = distribution_name(poetry.package.name)
+    name = dist_name(poetry.package.name)
     nar = project_dir / "dist" / f"{name}-{poetry.package.version}.nar"
 
     assert nar.exists()
 
-    with ZipFile(nar, "r") as file:
-        file.testzip()
-
-        assert "META-INF/MANIFEST.MF" in file.namelist()
+    with open_nar(nar) as (file, infos):
+        assert "META-INF/MANIFEST.MF" in infos
 
-        manifest = file.read("META-INF/MANIFEST.MF").decode()
+        manifest = file.read(infos["META-INF/MANIFEST.MF"]).decode()
 
         assert "Manifest-Version: 1.0" in manifest
         assert "Created-By: poetry-plugin-nar" in manifest
@@ -145,22 +157,38 @@ def test_build_package_with_dependency(
         assert f"Nar-Group: {poetry.package.name}" in manifest
         assert f"Nar-Version: {poetry.package.version}" in manifest
 
-        assert "META-INF/README.md" in file.namelist()
-        assert "META-INF/LICENSE" in file.namelist()
+        assert "META-INF/README.md" in infos
+        assert "META-INF/LICENSE" in infos
 
-        assert f"{name}/__init__.py" in file.namelist()
+        assert f"{name}/__init__.py" in infos
 
-        assert (
-            "NAR-INF/bundled-dependencies/numpy/__init__.py"
-            in file.namelist()
-        )
-        assert any(
-            re.search(
-                r"NAR-INF/bundled-dependencies/numpy-\d+\.\d+\.\d+\.dist-info/WHEEL",
-                f,
-            )
-            for f in file.namelist()
+        assert "NAR-INF/bundled-dependencies/numpy/__init__.py" in infos
+
+        wheel_re = re.compile(
+            r"NAR-INF/bundled-dependencies/numpy-\d+\.\d+\.\d+\.dist-info/WHEEL"
         )
+        assert any(wheel_re.search(f) for f in infos)
+
+
+@pytest.mark.slow
+@pytest.mark.xdist_group("dependency")
+@pytest.mark.usefixtures("shared_pip_cache")
+@pytest.mark.parametrize("project", ["package-with-path-dependency"])
+def test_build_package_with_path_dependency(
+    poetry: Poetry, project_dir: Path
+) -> None:
+    NarBuilder(poetry).build()
+
+    name = dist_name(poetry.package.name)
+    nar = project_dir / "dist" / f"{name}-{poetry.package.version}.nar"
+
+    deps = "NAR-INF/bundled-dependencies"
+
+    with open_nar(nar) as (_, infos):
+        # pip download saves no archive for a folder, it is installed
+        # alongside the dependencies downloaded from the index
+        assert f"{deps}/local_dep/__init__.py" in infos
+        assert f"{deps}/six.py" in infos
 
 
 @pytest.mark.parametrize("project", ["package-format-nar"])
@@ -181,15 +209,291 @@ def test_build_package_dynamic_metadata(
 ) -> None:
     NarBuilder(poetry).build()
 
-    name = distribution_name(poetry.package.name)
+    name = dist_name(poetry.package.name)
     nar = project_dir / "dist" / f"{name}-{poetry.package.version}.nar"
 
     assert nar.exists()
 
-    with ZipFile(nar, "r") as file:
-        file.testzip()
-
-        metadata = file.read(f"{name}/processor.py").decode()
+    with open_nar(nar) as (file, infos):
+        metadata = file.read(infos[f"{name}/processor.py"]).decode()
 
         assert f'version = "{poetry.package.version}"' in metadata
         assert f'description = "{poetry.package.description}"' in metadata
+
+
+@pytest.mark.parametrize("project", ["dynamic-package"])
+def test_build_package_folder_entries(
+    poetry: Poetry, project_dir: Path
+) -> None:
+    NarBuilder(poetry).build()
+
+    name = dist_name(poetry.package.name)
+    nar = project_dir / "dist" / f"{name}-{poetry.package.version}.nar"
+
+    with open_nar(nar) as (file, infos):
+        names = file.namelist()
+
+    folders = [n for n in names if n.endswith("/")]
+
+    assert folders == ["META-INF/", f"{name}/"]
+    assert all(infos[f].is_dir() for f in folders)
+
+    # each folder has a single entry, which comes before its first file
+    for n in names:
+        parent = n.rstrip("/").rpartition("/")[0]
+
+        if parent:
+            assert names.index(f"{parent}/") < names.index(n)
+
+
+@pytest.mark.parametrize("project", ["pretty-print-json"])
+def test_build_package_skips_nested_bytecode(
+    poetry: Poetry, project_dir: Path
+) -> None:
+    name = dist_name(poetry.package.name)
+
+    sub = project_dir / name / "sub"
+    (sub / "__pycache__").mkdir(parents=True)
+    (sub / "__init__.py").write_text("")
+    (sub / "__pycache__" / "__init__.cpython-311.pyc").write_bytes(b"")
+
+    NarBuilder(poetry).build()
+
+    nar = project_dir / "dist" / f"{name}-{poetry.package.version}.nar"
+
+    with open_nar(nar) as (_, infos):
+        assert f"{name}/sub/__init__.py" in infos
+        assert not [n for n in infos if "__pycache__" in n]
+
+
+@pytest.mark.parametrize("project", ["package-with-compresslevel"])
+def test_build_package_compresslevel(
+    poetry: Poetry, project_dir: Path
+) -> None:
+    NarBuilder(poetry).build()
+
+    name = dist_name(poetry.package.name)
+    nar = project_dir / "dist" / f"{name}-{poetry.package.version}.nar"
+
+    assert nar.exists()
+
+    with open_nar(nar) as (file, infos):
+        readme = infos["META-INF/README.md"]
+
+        # level 0 only wraps the content in stored deflate blocks
+        assert readme.compress_type == ZIP_DEFLATED
+        assert readme.compress_size >= readme.file_size
+
+
+@pytest.mark.parametrize("project", ["package-with-license"])
+def test_build_package_stores_compressed_files(
+    poetry: Poetry, project_dir: Path
+) -> None:
+    name = dist_name(poetry.package.name)
+    (project_dir / name / "image.png").write_bytes(b"\x89PNG" * 256)
+
+    NarBuilder(poetry).build()
+
+    nar = project_dir / "dist" / f"{name}-{poetry.package.version}.nar"
+
+    assert nar.exists()
+
+    with open_nar(nar) as (file, infos):
+        image = infos[f"{name}/image.png"]
+        init = infos[f"{name}/__init__.py"]
+
+        assert image.compress_type == ZIP_STORED
+        assert image.compress_size == image.file_size
+        assert init.compress_type == ZIP_DEFLATED
+
+
+@pytest.mark.parametrize(
+    "project",
+    [
+        "pretty-print-json",
+        "package-in-src",
+        "multiple-readme",
+        "package-with-license",
+        "dynamic-package",
+        "package-with-compresslevel",
+    ],
+)
+def test_nar_archive_integrity(poetry: Poetry, project_dir: Path) -> None:
+    NarBuilder(poetry).build()
+
+    name = dist_name(poetry.package.name)
+    nar = project_dir / "dist" / f"{name}-{poetry.package.version}.nar"
+
+    with open_nar(nar) as (file, _):
+        assert file.testzip() is None
+
+
+@pytest.fixture
+def wheel(tmp_path: Path) -> Path:
+    path = tmp_path / "wheels" / "demo-1.0-py3-none-any.whl"
+    path.parent.mkdir()
+
+    files = {
+        "demo/__init__.py": 0o644,
+        "demo/native.so": 0o755,
+        "demo-1.0.data/scripts/demo-tool": 0o755,
+        "demo-1.0.data/purelib/demo_extra/__init__.py": 0o644,
+        "demo-1.0.data/headers/demo.h": 0o644,
+        "demo-1.0.data/data/share/demo.txt": 0o644,
+        "demo-1.0.data/unknown/ignored.txt": 0o644,
+        "demo-1.0.dist-info/WHEEL": 0o644,
+        "demo-1.0.dist-info/entry_points.txt": 0o644,
+    }
+
+    with ZipFile(path, "w") as whl:
+        for name, mode in files.items():
+            info = ZipInfo(name)
+            info.external_attr = mode << 16
+            whl.writestr(info, name)
+
+    return path
+
+
+def test_unpack_wheel_layout(wheel: Path, tmp_path: Path) -> None:
+    target = tmp_path / "target"
+
+    _unpack_wheel(wheel, target)
+
+    assert (target / "demo" / "__init__.py").is_file()
+    assert (target / "demo-1.0.dist-info" / "WHEEL").is_file()
+
+    # the folders of the .data folder go where WHEEL_DATA_PATHS puts
+    # them, unknown ones are dropped along with the .data folder
+    assert (target / "bin" / "demo-tool").is_file()
+    assert (target / "demo_extra" / "__init__.py").is_file()
+    assert (target / "include" / "demo.h").is_file()
+    assert (target / "share" / "demo.txt").is_file()
+    assert not (target / "demo-1.0.data").exists()
+
+    # no launchers are generated for the console scripts
+    assert list((target / "bin").iterdir()) == [target / "bin" / "demo-tool"]
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="no executable bit")
+def test_unpack_wheel_keeps_executable_bit(
+    wheel: Path, tmp_path: Path
+) -> None:
+    target = tmp_path / "target"
+
+    _unpack_wheel(wheel, target)
+
+    assert os.stat(target / "demo" / "native.so").st_mode & 0o111
+    assert os.stat(target / "bin" / "demo-tool").st_mode & 0o111
+    assert not os.stat(target / "demo" / "__init__.py").st_mode & 0o111
+
+
+def test_merge_folder(tmp_path: Path) -> None:
+    src = tmp_path / "src"
+    dst = tmp_path / "dst"
+
+    (src / "namespace").mkdir(parents=True)
+    (src / "namespace" / "a.py").write_text("a")
+    (src / "module.py").write_text("new")
+    (src / "replaced").write_text("file")
+
+    (dst / "namespace").mkdir(parents=True)
+    (dst / "namespace" / "b.py").write_text("b")
+    (dst / "module.py").write_text("old")
+    (dst / "replaced").mkdir()
+    (dst / "replaced" / "c.py").write_text("c")
+
+    _merge_folder(src, dst)
+
+    # folders found in both are merged, anything else is replaced
+    assert (dst / "namespace" / "a.py").read_text() == "a"
+    assert (dst / "namespace" / "b.py").read_text() == "b"
+    assert (dst / "module.py").read_text() == "new"
+    assert (dst / "replaced").read_text() == "file"
+
+
+@pytest.mark.parametrize("project", ["write-numpy-version"])
+def test_build_package_with_wheel_and_sdist_dependencies(
+    poetry: Poetry,
+    project_dir: Path,
+    wheel: Path,
+    mocker: MockerFixture,
+) -> None:
+    def execute(
+        command: list[str], env: dict[str, str] | None = None
+    ) -> None:
+        if "download" in command:
+            dest = Path(command[command.index("--dest") + 1])
+            shutil.copy(wheel, dest)
+            (dest / "legacy-1.0.tar.gz").write_bytes(b"")
+        elif "install" in command:
+            # only the source distribution is left for pip to install
+            assert any(c.endswith("legacy-1.0.tar.gz") for c in command)
+            assert not any(c.endswith(".whl") for c in command)
+
+            target = Path(command[command.index("--target") + 1])
+            (target / "legacy").mkdir()
+            (target / "legacy" / "__init__.py").write_text("")
+
+            if sys.platform != "win32":
+                (target / "legacy" / "dangling").symlink_to("missing")
+
+    def export(fmt: str, cwd: Path, output: str) -> None:
+        Path(output).write_text("demo==1.0\nlegacy==1.0\n")
+
+    exporter = mocker.patch("poetry_plugin_nar.nar.Exporter")
+    exporter.return_value.export.side_effect = export
+    mocker.patch.object(NarBuilder, "_execute_command", side_effect=execute)
+
+    NarBuilder(poetry).build()
+
+    name = dist_name(poetry.package.name)
+    nar = project_dir / "dist" / f"{name}-{poetry.package.version}.nar"
+
+    deps = "NAR-INF/bundled-dependencies"
+
+    with open_nar(nar) as (_, infos):
+        assert f"{deps}/demo/__init__.py" in infos
+        assert f"{deps}/demo_extra/__init__.py" in infos
+        assert f"{deps}/bin/demo-tool" in infos
+        assert f"{deps}/legacy/__init__.py" in infos
+        assert f"{deps}/legacy/dangling" not in infos
+
+        if sys.platform != "win32":
+            tool = infos[f"{deps}/bin/demo-tool"]
+            assert (tool.external_attr >> 16) & 0o777 == 0o755
+
+
+@pytest.mark.parametrize("project", ["write-numpy-version"])
+def test_build_package_dependency_error(
+    poetry: Poetry, project_dir: Path, mocker: MockerFixture
+) -> None:
+    mocker.patch.object(
+        NarBuilder,
+        "_execute_command",
+        side_effect=CalledProcessError(1, "poetry"),
+    )
+
+    # the error from the worker preparing the dependencies is re-raised
+    with pytest.raises(CalledProcessError):
+        NarBuilder(poetry).build()
+
+    # and the partial nar is removed
+    assert list((project_dir / "dist").iterdir()) == []
+
+
+@pytest.mark.parametrize("project", ["write-numpy-version"])
+def test_build_package_invalid_compresslevel(
+    poetry: Poetry, project_dir: Path, mocker: MockerFixture
+) -> None:
+    pyproject = project_dir / "pyproject.toml"
+    pyproject.write_text(
+        pyproject.read_text() + "\n[tool.nar]\ncompresslevel = 10\n"
+    )
+
+    execute = mocker.patch.object(NarBuilder, "_execute_command")
+
+    with pytest.raises(ValueError, match="Invalid compresslevel: 10"):
+        NarBuilder(poetry).build()
+
+    # raised before the dependencies are prepared
+    execute.assert_not_called()